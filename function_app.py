@@ -1,26 +1,64 @@
 import logging
-import http.client
-import json
+import hashlib
 import os
-from azure.storage.blob import BlobServiceClient
+import time
+import ijson
+import numpy as np
+import orjson
+import requests
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from requests.adapters import HTTPAdapter
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient, BlobType, ContentSettings
 import azure.functions as func
 from datetime import datetime, timezone
-from jinja2 import Template
+from email.utils import parsedate_to_datetime
+from jinja2 import Environment
 
 # WaniKani information
 WANIKANI_BASE_URL = "api.wanikani.com"
+WANIKANI_URL_PREFIX = f"https://{WANIKANI_BASE_URL}"
 WANIKANI_API_KEY = os.getenv("WANIKANI_API_KEY")
 
 # Azure Blob Storage configuration
 BLOB_CONNECTION_STRING = os.getenv("BLOB_CONNECTION_STRING")
 BLOB_CONTAINER_NAME = "appdata"
 BLOB_NAME = "wanikani_stats.json"
+BLOB_STAGING_NAME = BLOB_NAME + ".tmp"
+
+# Fields stored for each day, in the order they follow the date in each history line
+HISTORY_FIELDS = ["level", "apprentice", "guru", "master", "enlightened", "burned", "last_updated"]
+
+# Shared Blob Storage clients, created on first use and reused across invocations
+BLOB_TRANSPORT = RequestsTransport()
+BLOB_SERVICE_CLIENT = None
+BLOB_CLIENT = None
+BLOB_STAGING_CLIENT = None
+
+# Rendered history page, reused until the blob ETag changes
+RENDER_CACHE = {"etag": None, "html": None}
 
 # Headers for API requests
 HEADERS = {
     "Authorization": f"Bearer {WANIKANI_API_KEY}"
 }
 
+# SRS stage groups fetched in parallel, one paginated walk each
+SRS_STAGE_GROUPS = ["1,2,3,4", "5,6", "7", "8", "9"]
+
+# Shared HTTP session so paginated calls reuse one pooled keep-alive connection
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+# Next pages requested while the current page is parsed, on top of one open page per stage group
+PREFETCH_LIMIT = 3
+PREFETCH_SLOTS = BoundedSemaphore(PREFETCH_LIMIT)
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=PREFETCH_LIMIT)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger()
@@ -51,86 +89,308 @@ def write_to_blob_trigger(req: func.HttpRequest) -> func.HttpResponse:
 def write_to_blob() -> None:
     try:
         logger.info("Timer triggered. Starting data fetch process...")
-        logger.info(f"API KEY: {WANIKANI_API_KEY}")
 
-        # Fetch data from WaniKani
-        srs_totals = get_srs_totals()
+        metadata, etag = read_blob_properties()
+
+        # One clock read for today's key and last_updated
+        now = datetime.now(timezone.utc)
+        today = now.strftime("%Y-%m-%d")
+        last_updated = now.isoformat()
+
+        # Fetch data from WaniKani, reusing the cached totals if no assignment changed
+        srs_totals = get_cached_srs_totals(metadata)
+        if srs_totals is None:
+            srs_totals, updated_after = get_srs_totals()
+        else:
+            updated_after = metadata["updated_after"]
+        apprentice = srs_totals[1] + srs_totals[2] + srs_totals[3] + srs_totals[4]
+        guru = srs_totals[5] + srs_totals[6]
+        master, enlightened, burned = srs_totals[7], srs_totals[8], srs_totals[9]
 
         # Log final totals
         logger.info("All pages processed. Final SRS Stage Totals:")
-        logger.info(f"Apprentice: {sum(srs_totals[i] for i in range(1, 5))}")
-        logger.info(f"Guru: {sum(srs_totals[i] for i in range(5, 7))}")
-        logger.info(f"Master: {srs_totals[7]}")
-        logger.info(f"Enlightened: {srs_totals[8]}")
-        logger.info(f"Burned: {srs_totals[9]}")
+        logger.info(f"Apprentice: {apprentice}")
+        logger.info(f"Guru: {guru}")
+        logger.info(f"Master: {master}")
+        logger.info(f"Enlightened: {enlightened}")
+        logger.info(f"Burned: {burned}")
 
         # Fetch user level
         level = get_level()
 
-        # Read existing data from the blob
-        existing_data = read_blob()
+        # Skip the blob round-trip if today's record already holds these values; moves between
+        # stages of the same bucket only refresh the cached per-stage totals below
+        digest = hashlib.blake2b(repr((today, level, apprentice, guru, master, enlightened, burned)).encode(),
+                                 digest_size=8).hexdigest()
+        new_metadata = {
+            "srs_digest": digest,
+            "srs_totals": ",".join(str(count) for count in srs_totals),
+            "updated_after": updated_after,
+            "record_date": today
+        }
+        if metadata.get("srs_digest") == digest:
+            if metadata != new_metadata:
+                write_blob_metadata(new_metadata, etag)
+            logger.info("SRS totals and level unchanged since last write. Skipping blob update.")
+            return
 
-        # Update data for today's date
-        today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-        existing_data[today] = {
+        record = {
             "level": level,
-            "apprentice": sum(srs_totals[i] for i in range(1, 5)),
-            "guru": sum(srs_totals[i] for i in range(5, 7)),
-            "master": srs_totals[7],
-            "enlightened": srs_totals[8],
-            "burned": srs_totals[9],
-            "last_updated": datetime.now(timezone.utc).isoformat()
+            "apprentice": apprentice,
+            "guru": guru,
+            "master": master,
+            "enlightened": enlightened,
+            "burned": burned,
+            "last_updated": last_updated
         }
-
-        # Write updated data back to the blob
-        write_blob(existing_data)
+        if metadata.get("record_date") == today:
+            # Reruns the same day rewrite the history so it keeps one line per date
+            rewrite_blob(today, record, new_metadata)
+        else:
+            append_record(today, record, new_metadata)
 
     except Exception as e:
         logger.error(f"An error occurred: {e}", exc_info=True)
 
-def read_blob():
-    """Read JSON data from Azure Blob Storage."""
+def get_blob_client():
+    """Return the shared blob client, creating it on first use."""
+    global BLOB_SERVICE_CLIENT, BLOB_CLIENT
+    if BLOB_CLIENT is None:
+        BLOB_SERVICE_CLIENT = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING, transport=BLOB_TRANSPORT)
+        BLOB_CLIENT = BLOB_SERVICE_CLIENT.get_blob_client(container=BLOB_CONTAINER_NAME, blob=BLOB_NAME)
+    return BLOB_CLIENT
+
+def get_staging_blob_client():
+    """Return the shared client for the blob rewrites are staged in, creating it on first use."""
+    global BLOB_STAGING_CLIENT
+    if BLOB_STAGING_CLIENT is None:
+        get_blob_client()
+        BLOB_STAGING_CLIENT = BLOB_SERVICE_CLIENT.get_blob_client(container=BLOB_CONTAINER_NAME, blob=BLOB_STAGING_NAME)
+    return BLOB_STAGING_CLIENT
+
+def create_container():
+    """Create the blob container, tolerating another run having just created it."""
+    get_blob_client()
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
-        blob_client = blob_service_client.get_blob_client(container=BLOB_CONTAINER_NAME, blob=BLOB_NAME)
+        BLOB_SERVICE_CLIENT.create_container(BLOB_CONTAINER_NAME)
+        logger.info(f"Created container: {BLOB_CONTAINER_NAME}")
+    except ResourceExistsError:
+        pass
 
-        logger.info(f"Reading blob: {BLOB_NAME} from container: {BLOB_CONTAINER_NAME}")
-        blob_data = blob_client.download_blob().readall()
-        return json.loads(blob_data)
-    except Exception as e:
-        logger.warning(f"Blob not found or empty. Returning empty dictionary. Error: {e}")
-        return {}
+def read_blob_with_etag(unless_etag=None, blob_client=None):
+    """Read the history as columns, {"dates": [...], "level": [...], ...}, with the ETag of the version read.
+
+    Each line of the blob is one [date, level, apprentice, ...] row. If a date appears on more
+    than one line, the last line wins.
 
-def write_blob(data):
-    """Write JSON data to Azure Blob Storage."""
+    If unless_etag is given and the blob still has that ETag, returns (None, unless_etag) without downloading it.
+    Reads the history blob unless another blob_client is given.
+    """
+    try:
+        blob_client = blob_client or get_blob_client()
+
+        logger.info(f"Reading blob: {blob_client.blob_name} from container: {BLOB_CONTAINER_NAME}")
+        if unless_etag is None:
+            download = blob_client.download_blob()
+        else:
+            download = blob_client.download_blob(etag=unless_etag, match_condition=MatchConditions.IfModified)
+        rows = {}
+        lines = iter_lines(download.chunks())
+        for line in lines:
+            if line == b"{":
+                # Pretty-printed single JSON document written before the JSON-lines layout
+                line = b"\n".join([line, *lines])
+            if not line.strip():
+                continue
+            parsed = orjson.loads(line)
+            if isinstance(parsed, dict):
+                # {date: record} objects written before the row layout
+                for date, record in parsed.items():
+                    rows[date] = [record[field] for field in HISTORY_FIELDS]
+            else:
+                rows[parsed[0]] = parsed[1:]
+        return history_columns(rows), download.properties.etag
+    except Exception as e:
+        if isinstance(e, HttpResponseError) and e.status_code == 304:
+            # The SDK surfaces the IfModified 304 as a generic HttpResponseError
+            return None, unless_etag
+        logger.warning(f"Blob not found or empty. Returning empty history. Error: {e}")
+        return history_columns({}), None
+
+def history_columns(rows):
+    """Build the columnar history from {date: [field values]}, sorted by date."""
+    dates = sorted(rows)
+    history = {"dates": dates}
+    for index, field in enumerate(HISTORY_FIELDS):
+        history[field] = [rows[date][index] for date in dates]
+    return history
+
+def add_history_record(history, date, record):
+    """Insert or replace one day's record in the columnar history, keeping dates sorted."""
+    dates = history["dates"]
+    index = bisect_left(dates, date)
+    if index < len(dates) and dates[index] == date:
+        for field in HISTORY_FIELDS:
+            history[field][index] = record[field]
+    else:
+        dates.insert(index, date)
+        for field in HISTORY_FIELDS:
+            history[field].insert(index, record[field])
+
+def read_blob_properties():
+    """Read the metadata and ETag stored alongside the blob."""
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
+        properties = get_blob_client().get_blob_properties()
+        return properties.metadata, properties.etag
+    except Exception as e:
+        logger.warning(f"Blob properties not available. Returning empty metadata. Error: {e}")
+        return {}, None
+
+def iter_lines(chunks):
+    """Yield complete lines from an iterable of byte chunks."""
+    pending = b""
+    for chunk in chunks:
+        *lines, pending = (pending + chunk).split(b"\n")
+        yield from lines
+    if pending:
+        yield pending
+
+def iter_history_lines(history):
+    """Yield one [date, level, apprentice, ...] JSON line per date in the columnar history."""
+    for row in zip(history["dates"], *(history[field] for field in HISTORY_FIELDS)):
+        yield orjson.dumps(row) + b"\n"
+
+def write_blob(history, metadata=None, etag=None):
+    """Write the full JSON-lines history to Azure Blob Storage as a new append blob.
+
+    The history is staged in a separate append blob and copied over the blob once complete, so a failed
+    write never leaves the blob partly written. The copy only succeeds if the blob still matches etag,
+    or is still missing when etag is None. The metadata is only set once the copy is committed.
+    """
+    try:
+        blob_client = get_blob_client()
+        staging_client = get_staging_blob_client()
 
-        container_client = blob_service_client.get_container_client(BLOB_CONTAINER_NAME)
-        if not container_client.exists():
-            container_client.create_container()
-            logger.info(f"Created container: {BLOB_CONTAINER_NAME}")
+        logger.info(f"Writing blob: {BLOB_NAME} to container: {BLOB_CONTAINER_NAME}")
 
-        blob_client = container_client.get_blob_client(BLOB_NAME)
+        def stage():
+            staging_client.create_append_blob(content_settings=ContentSettings(content_type="application/x-ndjson"))
 
-        logger.info(f"Writing blob: {BLOB_NAME} to container: {BLOB_CONTAINER_NAME}")
+        try:
+            stage()
+        except ResourceNotFoundError:
+            # Only the very first write runs before the container exists
+            create_container()
+            stage()
+        staged = staging_client.upload_blob(iter_history_lines(history), blob_type=BlobType.APPENDBLOB, length=None)
+
+        def copy(**conditions):
+            return blob_client.start_copy_from_url(staging_client.url, source_etag=staged["etag"],
+                                                   source_match_condition=MatchConditions.IfNotModified, **conditions)
 
-        blob_client.upload_blob(json.dumps(data, indent=4), overwrite=True)
+        try:
+            if etag is None:
+                copied = copy(match_condition=MatchConditions.IfMissing)
+            else:
+                try:
+                    copied = copy(etag=etag, match_condition=MatchConditions.IfNotModified)
+                except HttpResponseError as e:
+                    if e.error_code != "InvalidBlobType":
+                        raise
+                    # A copy cannot change the blob type, so a block blob written before the append-only
+                    # layout is removed first. Its history stays staged until the copy succeeds.
+                    blob_client.delete_blob(etag=etag, match_condition=MatchConditions.IfNotModified)
+                    copied = copy(match_condition=MatchConditions.IfMissing)
+        except HttpResponseError as e:
+            if e.error_code != "SourceConditionNotMet":
+                raise
+            # Another run restaged its own history before this copy started
+            raise ResourceModifiedError(message=e.message, response=e.response) from e
+
+        # Copies within one account normally complete at once, but may still be reported as pending
+        while copied["copy_status"] == "pending":
+            time.sleep(1)
+            properties = blob_client.get_blob_properties()
+            copied = {"copy_status": properties.copy.status, "etag": properties.etag}
+        if copied["copy_status"] != "success":
+            raise Exception(f"Copying {BLOB_STAGING_NAME} over {BLOB_NAME} ended with status {copied['copy_status']}")
         logger.info("Blob successfully written.")
+    except (ResourceExistsError, ResourceModifiedError):
+        raise
     except Exception as e:
         logger.error(f"Failed to write blob. Error: {e}")
+        raise
+
+    try:
+        # Leave the staging blob alone if another run has restaged it since
+        staging_client.delete_blob(etag=staged["etag"], match_condition=MatchConditions.IfNotModified)
+    except Exception as e:
+        logger.warning(f"Failed to delete staging blob {BLOB_STAGING_NAME}. Error: {e}")
+
+    # Only describe the copied rows if no other run has appended after them
+    if metadata:
+        write_blob_metadata(metadata, copied["etag"])
+
+def rewrite_blob(date, record, metadata):
+    """Rewrite the whole history with one day's record, retrying once if another run changed it meanwhile."""
+    for attempt in range(2):
+        history, etag = read_blob_with_etag()
+        if etag is None:
+            # A rewrite that failed after removing a block blob left its history staged
+            history, _ = read_blob_with_etag(blob_client=get_staging_blob_client())
+        add_history_record(history, date, record)
+        try:
+            write_blob(history, metadata=metadata, etag=etag)
+            return
+        except (ResourceExistsError, ResourceModifiedError) as e:
+            logger.warning(f"Blob {BLOB_NAME} changed while rewriting it (attempt {attempt + 1}). Error: {e}")
+    raise Exception(f"Blob {BLOB_NAME} kept changing while rewriting it.")
+
+def append_record(date, record, metadata):
+    """Append one day's record to the blob, creating or converting it to an append blob if needed."""
+    blob_client = get_blob_client()
+    try:
+        logger.info(f"Appending record for {date} to blob: {BLOB_NAME}")
+        row = [date, *(record[field] for field in HISTORY_FIELDS)]
+        appended = blob_client.append_block(orjson.dumps(row) + b"\n")
+        logger.info("Record successfully appended.")
+    except ResourceNotFoundError:
+        logger.info(f"Blob {BLOB_NAME} not found. Creating it.")
+        rewrite_blob(date, record, metadata)
+        return
+    except HttpResponseError as e:
+        if e.error_code == "InvalidBlobType":
+            # History written as a block blob before the append-only layout
+            logger.info(f"Converting blob {BLOB_NAME} to an append blob.")
+        elif e.error_code == "BlockCountExceedsLimit":
+            logger.info(f"Blob {BLOB_NAME} has no appends left. Compacting it.")
+        else:
+            raise
+        rewrite_blob(date, record, metadata)
+        return
+
+    # Only describe our line if no other run has appended after it
+    write_blob_metadata(metadata, appended["etag"])
+
+def write_blob_metadata(metadata, etag):
+    """Replace the metadata stored alongside the blob, unless the blob changed since etag."""
+    try:
+        get_blob_client().set_blob_metadata(metadata, etag=etag, match_condition=MatchConditions.IfNotModified)
+        logger.info("Blob metadata successfully written.")
+    except ResourceModifiedError:
+        logger.info("Blob changed since it was read. Leaving its newer metadata in place.")
+    except Exception as e:
+        logger.error(f"Failed to write blob metadata. Error: {e}")
 
 def get_level() -> int:
     """Fetch level from WaniKani API"""
     endpoint = "/v2/user"
     try:
         logger.info(f"Making API call to {WANIKANI_BASE_URL}{endpoint}")
-        conn = http.client.HTTPSConnection(WANIKANI_BASE_URL)
-        conn.request("GET", endpoint, headers=HEADERS)
-        response = conn.getresponse()
-        if response.status != 200:
-            raise Exception(f"API call failed with status code {response.status}")
-        data = json.loads(response.read().decode())
+        response = SESSION.get(WANIKANI_URL_PREFIX + endpoint, headers=HEADERS, timeout=30)
+        if response.status_code != 200:
+            raise Exception(f"API call failed with status code {response.status_code}")
+        data = response.json()
         level = data['data']['level']
         logger.info(f"User level fetched: {level}")
         return level
@@ -138,168 +398,235 @@ def get_level() -> int:
         logger.error(f"Error while fetching user level: {e}", exc_info=True)
         raise
 
-def get_srs_totals() -> dict:
-    """Fetch SRS totals from WaniKani API."""
-    srs_totals = {
-        1: 0,  # Apprentice 1
-        2: 0,  # Apprentice 2
-        3: 0,  # Apprentice 3
-        4: 0,  # Apprentice 4
-        5: 0,  # Guru 1
-        6: 0,  # Guru 2
-        7: 0,  # Master
-        8: 0,  # Enlightened
-        9: 0   # Burned
-    }
+def get_cached_srs_totals(metadata: dict):
+    """Return the SRS totals cached in blob metadata if no assignment changed since they were fetched."""
+    if "srs_totals" not in metadata or "updated_after" not in metadata:
+        return None
 
-    next_url = "/v2/assignments"
+    endpoint = f"/v2/assignments?updated_after={metadata['updated_after']}"
+    try:
+        logger.info(f"Making API call to {WANIKANI_BASE_URL}{endpoint}")
+        response = SESSION.get(WANIKANI_URL_PREFIX + endpoint, headers=HEADERS, timeout=30, stream=True)
+        try:
+            if response.status_code != 200:
+                raise Exception(f"API call failed with status code {response.status_code}")
+
+            # total_count precedes the data array, so stop parsing once it is known and
+            # discard the rest so the connection goes back to the session pool
+            response.raw.decode_content = True
+            changed_count = next(ijson.items(response.raw, "total_count"))
+            response.raw.drain_conn()
+        finally:
+            response.close()
+    except Exception as e:
+        logger.warning(f"Unable to check for assignment changes. Fetching all pages. Error: {e}")
+        return None
+
+    if changed_count:
+        logger.info(f"{changed_count} assignments changed since {metadata['updated_after']}. Fetching all pages.")
+        return None
+
+    logger.info(f"No assignments changed since {metadata['updated_after']}. Reusing cached SRS totals.")
+    return [int(count) for count in metadata["srs_totals"].split(",")]
+
+def get_srs_totals() -> tuple:
+    """Fetch SRS totals from WaniKani API, indexed by SRS stage, with the server time they are current as of."""
+    # 1-4: Apprentice 1-4, 5-6: Guru 1-2, 7: Master, 8: Enlightened, 9: Burned
+    srs_totals = [0] * 10
+    served_at = []
 
     try:
-        while next_url:
-            logger.info(f"Making API call to {WANIKANI_BASE_URL}{next_url}")
-
-            # Call the API
-            conn = http.client.HTTPSConnection(WANIKANI_BASE_URL)
-            conn.request("GET", next_url, headers=HEADERS)
-
-            response = conn.getresponse()
-            logger.info(f"Received response with status: {response.status}")
-            if response.status != 200:
-                logger.error(f"API call failed with status {response.status}: {response.reason}")
-                raise Exception(f"API call failed with status {response.status}: {response.reason}")
-
-            # Parse JSON response
-            logger.info("Parsing API response...")
-            data = json.loads(response.read().decode())
-            conn.close()
-
-            # Process the 'data' array
-            logger.info(f"Processing {len(data['data'])} items from the current page...")
-            for item in data["data"]:
-                srs_stage = item["data"]["srs_stage"]
-                if srs_stage in srs_totals:
-                    srs_totals[srs_stage] += 1
-
-            # Log current totals
-            logger.info(f"Current totals by SRS stage: {srs_totals}")
-
-            # Check if there's a next page
-            next_url = data["pages"].get("next_url")
-            if next_url:
-                if next_url:
-                    next_url = next_url.replace(f"https://{WANIKANI_BASE_URL}", "")
-                logger.info(f"Next page URL: {next_url}")
-            else:
-                logger.info("No more pages to process.")
+        # Each stage group has its own pagination cursor, so walk them concurrently
+        with ThreadPoolExecutor(max_workers=len(SRS_STAGE_GROUPS)) as executor:
+            for stage_counts, group_served_at in executor.map(count_srs_stages, SRS_STAGE_GROUPS):
+                for srs_stage in range(1, 10):
+                    srs_totals[srs_stage] += stage_counts[srs_stage]
+                served_at.append(group_served_at)
     except Exception as e:
         logger.error(f"Error while fetching or processing data: {e}", exc_info=True)
         raise
 
-    return srs_totals
+    # Compared against WaniKani's data_updated_at, so taken from its clock rather than ours
+    return srs_totals, min(served_at).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def fetch_assignments_page(path: str) -> requests.Response:
+    """Request one assignments page, leaving the body to be streamed by the caller."""
+    logger.debug("Making API call to %s%s", WANIKANI_BASE_URL, path)
+    response = SESSION.get(WANIKANI_URL_PREFIX + path, headers=HEADERS, timeout=30, stream=True)
+    logger.debug("Received response with status: %s", response.status_code)
+    return response
+
+def discard_prefetched_page(future) -> None:
+    """Free the prefetch slot of a page that will never be parsed."""
+    PREFETCH_SLOTS.release()
+    if future.exception() is None:
+        future.result().close()
+
+def count_srs_stages(srs_stages: str) -> tuple:
+    """Count assignments per SRS stage across every page for the given stages.
+
+    Also returns the server time the first page was served at, as the cutoff for later change checks.
+    """
+    # The srs_stages filter guarantees every stage seen is between 1 and 9
+    stage_counts = [0] * 10
+    served_at = None
+    response = fetch_assignments_page(f"/v2/assignments?srs_stages={srs_stages}")
+
+    while response is not None:
+        next_url = None
+        prefetched = None
+        try:
+            if response.status_code != 200:
+                logger.error(f"API call failed with status {response.status_code}: {response.reason}")
+                raise Exception(f"API call failed with status {response.status_code}: {response.reason}")
+            if served_at is None:
+                served_at = parsedate_to_datetime(response.headers["Date"])
+
+            # Stream the JSON response, keeping only the SRS stages and the next page URL
+            logger.debug("Parsing API response...")
+            response.raw.decode_content = True
+            item_count = 0
+            for prefix, event, value in ijson.parse(response.raw):
+                if prefix == "data.item.data.srs_stage":
+                    stage_counts[value] += 1
+                    item_count += 1
+                elif prefix == "pages.next_url" and value:
+                    next_url = value
+                    if next_url.startswith(WANIKANI_URL_PREFIX):
+                        next_url = next_url[len(WANIKANI_URL_PREFIX):]
+                    logger.debug("Next page URL: %s", next_url)
+
+                    # pages precedes data, so request the next page before this one's items are parsed
+                    if PREFETCH_SLOTS.acquire(blocking=False):
+                        prefetched = PREFETCH_EXECUTOR.submit(fetch_assignments_page, next_url)
+            logger.debug("Processed %d items from the current page...", item_count)
+        except Exception:
+            if prefetched is not None:
+                prefetched.add_done_callback(discard_prefetched_page)
+            raise
+        finally:
+            response.close()
+
+        # Log current totals
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Current totals for SRS stages %s: %s", srs_stages, stage_counts)
+
+        # Move on to the next page, fetching it now if no prefetch slot was free
+        if prefetched is not None:
+            try:
+                response = prefetched.result()
+            finally:
+                PREFETCH_SLOTS.release()
+        elif next_url:
+            response = fetch_assignments_page(next_url)
+        else:
+            response = None
+            logger.info(f"No more pages to process for SRS stages {srs_stages}.")
+
+    return stage_counts, served_at
+
+# Columns shown on the history page, each with its change from the previous day
+SRS_COLUMNS = ["apprentice", "guru", "master", "enlightened", "burned"]
+
+# History page template, compiled once at import
+HISTORY_HTML = """
+<html>
+<head>
+    <title>WaniKani History</title>
+</head>
+<body>
+    <h1 style="display: inline;">WaniKani History</h1>
+    <button style="margin-left: 10px;" onclick="triggerDataUpdate()">Update Data</button>
+    <table border="1" style="margin-top: 10px;">
+    <tr>
+    <th>Date</th>
+    <th>Level</th>
+    <th>Apprentice</th>
+    <th>Guru</th>
+    <th>Master</th>
+    <th>Enlightened</th>
+    <th>Burned</th>
+    <th>Total</th>
+    </tr>
+    {% for row in rows %}
+    <tr>
+    <td>{{ row.date }}</td>
+    <td>{{ row.level }}</td>
+    <td>{{ row.apprentice }}</td>
+    <td>{{ row.guru }}</td>
+    <td>{{ row.master }}</td>
+    <td>{{ row.enlightened }}</td>
+    <td>{{ row.burned }}</td>
+    <td>{{ row.total }}</td>
+    </tr>
+    {% endfor %}
+    </table>
+    <script>
+    function triggerDataUpdate() {
+    fetch('/write_to_blob', {
+    method: 'POST'
+    })
+    .then(response => {
+    if (response.ok) {
+        location.reload(); // Refresh the page
+    } else {
+        alert('Failed to trigger data update.');
+    }
+    })
+    .catch(error => {
+    console.error('Error:', error);
+    alert('An error occurred while triggering data update.');
+    });
+    }
+    </script>
+</body>
+</html>
+"""
+HISTORY_TEMPLATE = Environment(autoescape=True).from_string(HISTORY_HTML)
 
 @app.route(route="/", auth_level=func.AuthLevel.ANONYMOUS)
 def serve_website(req: func.HttpRequest) -> func.HttpResponse:
+    global RENDER_CACHE
     logging.info(f'Python HTTP trigger function processed a request from {req.url}')
 
     try:
-        data = read_blob()
-        dates = sorted(data.keys())  # Sort dates in ascending order
+        # Serve the cached page while the blob is unchanged, keyed on the ETag of the version downloaded
+        cache = RENDER_CACHE
+        data, etag = read_blob_with_etag(unless_etag=cache["etag"])
+        if data is None:
+            return cached_page_response(req, cache)
+        dates = data["dates"]  # Already sorted in ascending order
 
         if len(dates) < 2:
             return func.HttpResponse("Not enough data to compare.", status_code=200)
 
-        def format_with_difference(current, previous):
-            difference = current - previous
-            return f"{current} ({difference:+d})"
+        # Diff every SRS column (plus their total) against the previous day in one pass
+        counts = np.array([data[column] for column in SRS_COLUMNS], dtype=np.int64)
+        counts = np.vstack((counts, counts.sum(axis=0)))
+        differences = np.diff(counts, axis=1)
 
         rows = []
-        for i in range(1, len(dates)):
-            current_date = dates[i]
-            previous_date = dates[i - 1]
-
-            current_totals = data[current_date]
-            previous_totals = data[previous_date]
-
-            level = current_totals['level']
-            apprentice = format_with_difference(current_totals['apprentice'], previous_totals['apprentice'])
-            guru = format_with_difference(current_totals['guru'], previous_totals['guru'])
-            master = format_with_difference(current_totals['master'], previous_totals['master'])
-            enlightened = format_with_difference(current_totals['enlightened'], previous_totals['enlightened'])
-            burned = format_with_difference(current_totals['burned'], previous_totals['burned'])
-
-            current_total = current_totals['apprentice'] + current_totals['guru'] + current_totals['master'] + current_totals['enlightened'] + current_totals['burned']
-            previous_total = previous_totals['apprentice'] + previous_totals['guru'] + previous_totals['master'] + previous_totals['enlightened'] + previous_totals['burned']
-            total = format_with_difference(current_total, previous_total)
-
-            rows.append({
-                "date": current_date,
-                "level": level,
-                "apprentice": apprentice,
-                "guru": guru,
-                "master": master,
-                "enlightened": enlightened,
-                "burned": burned,
-                "total": total,
-            })
+        for date, level, current, difference in zip(dates[1:], data['level'][1:], counts[:, 1:].T.tolist(),
+                                                    differences.T.tolist()):
+            row = {"date": date, "level": level}
+            for column, value, change in zip(SRS_COLUMNS + ["total"], current, difference):
+                row[column] = f"{value} ({change:+d})"
+            rows.append(row)
 
         rows.reverse()  # Reverse the rows to display in descending order
 
-        table_html = """
-        <html>
-        <head>
-            <title>WaniKani History</title>
-        </head>
-        <body>
-            <h1 style="display: inline;">WaniKani History</h1>
-            <button style="margin-left: 10px;" onclick="triggerDataUpdate()">Update Data</button>
-            <table border="1" style="margin-top: 10px;">
-            <tr>
-            <th>Date</th>
-            <th>Level</th>
-            <th>Apprentice</th>
-            <th>Guru</th>
-            <th>Master</th>
-            <th>Enlightened</th>
-            <th>Burned</th>
-            <th>Total</th>
-            </tr>
-            {% for row in rows %}
-            <tr>
-            <td>{{ row.date }}</td>
-            <td>{{ row.level }}</td>
-            <td>{{ row.apprentice }}</td>
-            <td>{{ row.guru }}</td>
-            <td>{{ row.master }}</td>
-            <td>{{ row.enlightened }}</td>
-            <td>{{ row.burned }}</td>
-            <td>{{ row.total }}</td>
-            </tr>
-            {% endfor %}
-            </table>
-            <script>
-            function triggerDataUpdate() {
-            fetch('/write_to_blob', {
-            method: 'POST'
-            })
-            .then(response => {
-            if (response.ok) {
-                location.reload(); // Refresh the page
-            } else {
-                alert('Failed to trigger data update.');
-            }
-            })
-            .catch(error => {
-            console.error('Error:', error);
-            alert('An error occurred while triggering data update.');
-            });
-            }
-            </script>
-        </body>
-        </html>
-        """
-        template = Template(table_html)
-        rendered_html = template.render(rows=rows)
-        return func.HttpResponse(rendered_html, mimetype="text/html")
+        rendered_html = HISTORY_TEMPLATE.render(rows=rows)
+        RENDER_CACHE = {"etag": etag, "html": rendered_html}
+        return cached_page_response(req, RENDER_CACHE)
     except Exception as e:
         logging.error(f"Failed to serve JSON as table. Error: {e}")
-        return func.HttpResponse("An error occurred while serving the data.", status_code=500)
\ No newline at end of file
+        return func.HttpResponse("An error occurred while serving the data.", status_code=500)
+
+def cached_page_response(req: func.HttpRequest, cache: dict) -> func.HttpResponse:
+    """Build the response for a cached history page, honouring the browser's If-None-Match."""
+    headers = {"Cache-Control": "max-age=3600"}
+    if cache["etag"] is not None:
+        headers["ETag"] = cache["etag"]
+        if req.headers.get("If-None-Match") == cache["etag"]:
+            return func.HttpResponse(status_code=304, headers=headers)
+    return func.HttpResponse(cache["html"], mimetype="text/html", headers=headers)
\ No newline at end of file